@@ -0,0 +1,63 @@
+from functools import partial
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from nio import AsyncClient
+from nio.client.async_client import connect_wrapper, on_request_chunk_sent
+
+# orjson is optional, without it nio's own JSON parsing is used
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# How long (in seconds) to reuse the homeserver's DNS lookup
+DNS_CACHE_TTL = 600
+
+
+class BotClient(AsyncClient):
+    """An AsyncClient that parses response bodies with orjson when it is installed
+
+    Responses to a sync with full state can be several megabytes, parsing those
+    is where the stdlib json module spends most of the bot's CPU time.
+
+    It also caches DNS lookups for longer than aiohttp's default of 10 seconds, so
+    long polling syncs and reconnects don't keep resolving the homeserver. It has
+    to be created while the event loop is running.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # nio creates a session itself when none is set, leave that to nio when
+        # a proxy is used since it has to set up the proxy connector
+        if not self.proxy:
+            # Set up the session the same way nio does, the trace reports
+            # upload progress and the wrapper sets the write buffer limits
+            trace = TraceConfig()
+            trace.on_request_chunk_sent.append(on_request_chunk_sent)
+
+            self.client_session = ClientSession(
+                timeout=ClientTimeout(total=self.config.request_timeout),
+                trace_configs=[trace],
+                connector=TCPConnector(ttl_dns_cache=DNS_CACHE_TTL),
+            )
+
+            self.client_session.connector.connect = partial(
+                connect_wrapper,
+                self.client_session.connector,
+            )
+
+    async def parse_body(self, transport_response):
+        """Parse the body of a response
+
+        Args:
+            transport_response (aiohttp.ClientResponse): The response to parse
+        """
+        if orjson is None:
+            return await super().parse_body(transport_response)
+
+        try:
+            return orjson.loads(await transport_response.read())
+        except orjson.JSONDecodeError:
+            # Let nio deal with bodies that are not valid JSON
+            return await super().parse_body(transport_response)
@@ -1,7 +1,10 @@
 
 from chat_functions import send_text_to_room
+import asyncio
+import functools
 import logging
-from decimal import Decimal
+import time
+from dataclasses import dataclass
 
 # import needed for bme280 sensor
 import smbus2
@@ -10,15 +13,154 @@ import bme280
 # setup sensor bme280
 port = 1
 address = 0x76
-bus = smbus2.SMBus(port)
-calibration_params = bme280.load_calibration_params(bus, address)
+
+# bme280 registers
+REG_CTRL_HUM = 0xF2
+REG_STATUS = 0xF3
+REG_CTRL_MEAS = 0xF4
+REG_CONFIG = 0xF5
+REG_DATA = 0xF7
+DATA_LENGTH = 8
+
+MODE_NORMAL = 0b11
+STANDBY_1000_MS = 0b101
+FILTER_OFF = 0b000
+STATUS_MEASURING = 0b1000
+
+# Maximum time of one measurement with x1 oversampling, from the datasheet
+MEASUREMENT_TIME = 0.01
+
+
+def _configure_normal_mode(bus):
+    """Put the sensor in normal mode so that it measures continuously
+
+    Blocks until the first measurement is available.
+
+    The config register is only guaranteed to be written while the sensor
+    sleeps and ctrl_hum only takes effect after ctrl_meas is written, so the
+    order of the writes matters.
+    """
+    sampling = bme280.oversampling.x1
+    bus.write_byte_data(address, REG_CTRL_HUM, sampling)
+    bus.write_byte_data(address, REG_CONFIG,
+                        STANDBY_1000_MS << 5 | FILTER_OFF << 2)
+    bus.write_byte_data(address, REG_CTRL_MEAS,
+                        sampling << 5 | sampling << 2 | MODE_NORMAL)
+
+    # The data registers hold their reset values until the first measurement
+    # is done, wait for it so that it is not read and cached
+    time.sleep(MEASUREMENT_TIME)
+    deadline = time.monotonic() + MEASUREMENT_TIME
+    while (bus.read_byte_data(address, REG_STATUS) & STATUS_MEASURING
+           and time.monotonic() < deadline):
+        time.sleep(MEASUREMENT_TIME / 10)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_sensor():
+    """Open the I2C bus and set up the sensor on first use
+
+    Failures are not cached, so a missing sensor is retried on the next reading.
+
+    Returns:
+        (smbus2.SMBus, bme280.params): The bus and the calibration parameters
+    """
+    bus = smbus2.SMBus(port)
+    try:
+        calibration_params = bme280.load_calibration_params(bus, address)
+        _configure_normal_mode(bus)
+    except Exception:
+        # The setup is retried, don't leak a file descriptor every time
+        bus.close()
+        raise
+    return bus, calibration_params
+
+
+def _read_bme280():
+    """Read the latest measurement with a single burst read of the data registers"""
+    bus, calibration_params = _get_sensor()
+    write = smbus2.i2c_msg.write(address, [REG_DATA])
+    read = smbus2.i2c_msg.read(address, DATA_LENGTH)
+    bus.i2c_rdwr(write, read)
+    raw_readings = bme280.uncompensated_readings(list(read))
+    return bme280.compensated_readings(raw_readings, calibration_params)
+
+
+# How long (in seconds) a sensor reading is reused for
+CACHE_TTL = 10
+
+
+@dataclass
+class _Latest:
+    """The most recent sensor reading"""
+    temperature: float
+    pressure: float
+    humidity: float
+    # time.monotonic() at which the reading was taken
+    timestamp: float
+
+
+_latest = None
+_sample_lock = asyncio.Lock()
 
 logger = logging.getLogger(__name__)
 
 
-class Command(object):
-    def __init__(self, client, store, config, command, room, event):
-        """A command made by a user
+def _is_fresh(reading):
+    return reading is not None and time.monotonic() - reading.timestamp < CACHE_TTL
+
+
+async def _refresh_bme280():
+    """Take a new reading from the bme280 sensor and store it as the latest one"""
+    global _latest
+
+    # The I2C transaction is blocking, keep it off the event loop
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, _read_bme280)
+    _latest = _Latest(data.temperature, data.pressure, data.humidity,
+                      time.monotonic())
+    return _latest
+
+
+async def _sample_bme280():
+    """Get a reading from the bme280 sensor, reusing a recent one if available
+
+    While sensor_sampler is running this does not touch the sensor. Concurrent
+    callers share a single I2C transaction.
+    """
+    if _is_fresh(_latest):
+        return _latest
+
+    async with _sample_lock:
+        # Another caller may have refreshed the reading while we waited
+        if _is_fresh(_latest):
+            return _latest
+        return await _refresh_bme280()
+
+
+async def sensor_sampler(poll_rate_ms):
+    """Periodically read the bme280 sensor in the background
+
+    Args:
+        poll_rate_ms (int): Time between two readings in milliseconds
+    """
+    while True:
+        try:
+            async with _sample_lock:
+                await _refresh_bme280()
+        except OSError as e:
+            logger.warning("Unable to read the bme280 sensor: %s", e)
+        except Exception:
+            # Keep sampling, the next reading may well succeed
+            logger.exception("Unexpected error reading the bme280 sensor")
+        await asyncio.sleep(poll_rate_ms / 1000)
+
+
+class CommandContext(object):
+    __slots__ = ("client", "store", "config")
+
+    def __init__(self, client, store, config):
+        """The parts of a command's environment that are the same for every command
 
         Args:
             client (nio.AsyncClient): The client to communicate to matrix with
@@ -26,70 +168,125 @@ class Command(object):
             store (Storage): Bot storage
 
             config (Config): Bot configuration parameters
+        """
+        self.client = client
+        self.store = store
+        self.config = config
+
+
+async def process_command(ctx, command, room, event, reply_buffer=None):
+    """Process a command made by a user
+
+    Args:
+        ctx (CommandContext): The client, storage and configuration to use
+
+        command (str): The command and arguments
+
+        room (nio.rooms.MatrixRoom): The room the command was sent in
+
+        event (nio.events.room_events.RoomMessageText): The event describing the command
+
+        reply_buffer (list[str]|None): If given, replies are collected here instead
+            of being sent, so that the caller can send them together
+    """
+    logger.debug("Got command from %s: %r", event.sender, command)
+    # Only the keyword is lowercased, the arguments may be long
+    words = command.split(None, 1)
+    trigger = words[0].lower() if words else ""
+    handler = _HANDLERS.get(trigger, _unknown_command)
+    await handler(ctx, command, room, reply_buffer)
+
+
+async def _reply(ctx, room, reply_buffer, text):
+    """Send a reply to the room, or buffer it if a reply buffer is in use"""
+    if reply_buffer is not None:
+        reply_buffer.append(text)
+    else:
+        await send_text_to_room(ctx.client, room.room_id, text)
+
+
+async def _echo(ctx, command, room, reply_buffer):
+    """Echo back the command's arguments"""
+    response = " ".join(command.split()[1:])
+    await _reply(ctx, room, reply_buffer, response)
+
+
+async def _show_help(ctx, command, room, reply_buffer):
+    """Show the help text"""
+    args = command.split()[1:]
+    if not args:
+        text = (
+            "Hello, I am a bot made with matrix-nio! Use `help commands` to view "
+            "available commands."
+        )
+        await _reply(ctx, room, reply_buffer, text)
+        return
+
+    topic = args[0]
+    if topic == "rules":
+        text = "These are the rules!"
+    elif topic == "commands":
+        text = "Available commands: weather, echo"
+    else:
+        text = "Unknown help topic!"
+    await _reply(ctx, room, reply_buffer, text)
+
+
+async def _show_weather_bme280(ctx, command, room, reply_buffer):
+    try:
+        data = await _sample_bme280()
+    except OSError:
+        logger.exception("Unable to read the bme280 sensor")
+        await _reply(ctx, room, reply_buffer, "Unable to read the weather sensor.")
+        return
+    await _reply(
+        ctx, room, reply_buffer,
+        f"Current temperature {round(data.temperature)} C, pressure {round(data.pressure)}HPa and humidity {round(data.humidity)}%",
+    )
+
+
+async def _unknown_command(ctx, command, room, reply_buffer):
+    await _reply(
+        ctx, room, reply_buffer,
+        f"Unknown command '{command}'. Try the 'help' command for more information.",
+    )
+
+
+# Command triggers mapped to their handlers
+_HANDLERS = {
+    "echo": _echo,
+    "help": _show_help,
+    "weather": _show_weather_bme280,
+}
+
+
+class Command(object):
+    __slots__ = ("ctx", "command", "room", "event", "reply_buffer")
+
+    def __init__(self, ctx, command, room, event, reply_buffer=None):
+        """A command made by a user
+
+        Callbacks uses process_command directly, this wraps it for existing callers.
+
+        Args:
+            ctx (CommandContext): The client, storage and configuration to use
 
             command (str): The command and arguments
 
             room (nio.rooms.MatrixRoom): The room the command was sent in
 
             event (nio.events.room_events.RoomMessageText): The event describing the command
+
+            reply_buffer (list[str]|None): If given, replies are collected here instead
+                of being sent, so that the caller can send them together
         """
-        self.client = client
-        self.store = store
-        self.config = config
+        self.ctx = ctx
         self.command = command
         self.room = room
         self.event = event
-        self.args = self.command.split()[1:]
+        self.reply_buffer = reply_buffer
 
     async def process(self):
         """Process the command"""
-        logger.debug("Got command from %s: %r",
-                     self.event.sender, self.command)
-        trigger = self.command.lower().split(maxsplit=1)[0]
-        if trigger.startswith("echo"):
-            await self._echo()
-        elif trigger.startswith("help"):
-            await self._show_help()
-        elif trigger.startswith("weather"):
-            await self._show_weather_bme280()
-        else:
-            await self._unknown_command()
-
-    async def _echo(self):
-        """Echo back the command's arguments"""
-        response = " ".join(self.args)
-        await send_text_to_room(self.client, self.room.room_id, response)
-
-    async def _show_help(self):
-        """Show the help text"""
-        if not self.args:
-            text = (
-                "Hello, I am a bot made with matrix-nio! Use `help commands` to view "
-                "available commands."
-            )
-            await send_text_to_room(self.client, self.room.room_id, text)
-            return
-
-        topic = self.args[0]
-        if topic == "rules":
-            text = "These are the rules!"
-        elif topic == "commands":
-            text = "Available commands: weather, echo"
-        else:
-            text = "Unknown help topic!"
-        await send_text_to_room(self.client, self.room.room_id, text)
-
-    async def _show_weather_bme280(self):
-        data = bme280.sample(bus, address, calibration_params)
-        await send_text_to_room(
-            self.client,
-            self.room.room_id,
-            f"Current temperature {round(Decimal(data.temperature))} C, pressure {round(Decimal(data.pressure))}HPa and humidity {round(Decimal(data.humidity))}%",
-        )
-
-    async def _unknown_command(self):
-        await send_text_to_room(
-            self.client,
-            self.room.room_id,
-            f"Unknown command '{self.command}'. Try the 'help' command for more information.",
-        )
+        await process_command(self.ctx, self.command, self.room, self.event,
+                              self.reply_buffer)
@@ -1,25 +1,97 @@
-import traceback
-from bot_commands import Command
+import asyncio
+import os
+import sys
+from bot_commands import CommandContext, process_command
 from nio import (
     JoinError,
     MatrixRoom,
     UnknownEvent,
     KeyVerificationCancel,
-    KeyVerificationEvent,
     KeyVerificationKey,
     KeyVerificationMac,
     KeyVerificationStart,
     LocalProtocolError,
     ToDeviceError,
-    UpdateDeviceError
 )
-from message_responses import Message
+from message_responses import process_message
+from chat_functions import send_text_to_room
 
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+async def _retry(op, error_type, description, attempts=3, delay=0.1):
+    """Run a matrix request until it succeeds, backing off exponentially in between
+
+    Args:
+        op (callable): Returns a new awaitable request on each call
+
+        error_type (type): The error response type that marks a failed attempt
+
+        description (str): What the request does, for the log of failed attempts
+
+        attempts (int): How many times to try before giving up
+
+        delay (float): Seconds to wait after the first failure, doubled every time
+
+    Returns:
+        The successful response, or the last error response
+    """
+    for attempt in range(attempts):
+        result = await op()
+        if not isinstance(result, error_type):
+            return result
+        logger.error(
+            "Error %s (attempt %d): %s", description, attempt, result.message)
+        if attempt < attempts - 1:
+            await asyncio.sleep(delay)
+            delay *= 2
+    return result
+
+
+async def _ainput(prompt):
+    """Read a line from stdin without blocking the event loop
+
+    input() runs in the default executor, like any other blocking call. On a
+    terminal the loop watches stdin itself instead when it can: asyncio.run
+    joins the executor's threads on shutdown, so a prompt nobody answers would
+    keep Control-C from stopping the bot.
+
+    Args:
+        prompt (str): Written to stdout before reading
+    """
+    loop = asyncio.get_running_loop()
+    if not sys.stdin.isatty():
+        return await loop.run_in_executor(None, input, prompt)
+
+    fd = sys.stdin.fileno()
+    future = loop.create_future()
+
+    def read():
+        # Read the fd rather than sys.stdin, lines typed ahead must not end up
+        # in Python's buffer where the loop can't see them. A terminal hands
+        # out one line per read.
+        if not future.done():
+            future.set_result(os.read(fd, 4096))
+
+    try:
+        loop.add_reader(fd, read)
+    except NotImplementedError:
+        # e.g. the Proactor loop on Windows
+        return await loop.run_in_executor(None, input, prompt)
+
+    print(prompt, end="", flush=True)
+    try:
+        line = await future
+    finally:
+        loop.remove_reader(fd)
+
+    if not line:
+        raise EOFError("stdin was closed")
+    return line.decode(sys.stdin.encoding or "utf-8").rstrip("\r\n")
+
+
 class Callbacks(object):
 
     def __init__(self, client, store, config):
@@ -35,138 +107,140 @@ class Callbacks(object):
         self.store = store
         self.config = config
         self.command_prefix = config.command_prefix
+        # Needed for every line of every message
+        self._plen = len(config.command_prefix)
+        # Shared by every command, so it is only built once
+        self._ctx = CommandContext(client, store, config)
+        # The bot's own user ID, looked up on the first message
+        self._bot_user = None
+        # Handlers for the to-device events of the key verification flow
+        self._to_device_handlers = {
+            KeyVerificationStart: self._on_key_verification_start,
+            KeyVerificationCancel: self._on_key_verification_cancel,
+            KeyVerificationKey: self._on_key_verification_key,
+            KeyVerificationMac: self._on_key_verification_mac,
+        }
 
     async def to_device_callback(self, event):
         """Handle events sent to device."""
         try:
-            client = self.client
-
-            if isinstance(event, KeyVerificationStart):  # first step
-                if "emoji" not in event.short_authentication_string:
-                    print(
-                        "Other device does not support emoji verification "
-                        f"{event.short_authentication_string}."
-                    )
-                    return
-                resp = await client.accept_key_verification(
-                    event.transaction_id
-                )
-                if isinstance(resp, ToDeviceError):
-                    print(f"accept_key_verification failed with {resp}")
-
-                sas = client.key_verifications[event.transaction_id]
-
-                to_device_msg = sas.share_key()
-                resp = await client.to_device(to_device_msg)
-                if isinstance(resp, ToDeviceError):
-                    print(f"to_device failed with {resp}")
-
-            elif isinstance(event, KeyVerificationCancel):  # anytime
-                """ at any time: receive KeyVerificationCancel
-                KeyVerificationCancel(source={
-                    'content': {'code': 'm.mismatched_sas',
-                                'reason': 'Mismatched authentication string',
-                                'transaction_id': 'SomeTxId'},
-                    'type': 'm.key.verification.cancel',
-                    'sender': '@user2:example.org'},
-                    sender='@user2:example.org',
-                    transaction_id='SomeTxId',
-                    code='m.mismatched_sas',
-                    reason='Mismatched short authentication string')
-                """
-
-                # There is no need to issue a
-                # client.cancel_key_verification(tx_id, reject=False)
-                # here. The SAS flow is already cancelled.
-                # We only need to inform the user.
-                print(
-                    f"Verification has been cancelled by {event.sender} "
-                    f'for reason "{event.reason}".'
-                )
-
-            elif isinstance(event, KeyVerificationKey):  # second step
-                """ Second step is to receive KeyVerificationKey
-                KeyVerificationKey(
-                    source={'content': {
-                            'key': 'SomeCryptoKey',
-                            'transaction_id': 'SomeTxId'},
-                        'type': 'm.key.verification.key',
-                        'sender': '@user2:example.org'
-                    },
-                    sender='@user2:example.org',
-                    transaction_id='SomeTxId',
-                    key='SomeCryptoKey')
-                """
-                sas = client.key_verifications[event.transaction_id]
-
-                print(f"{sas.get_emoji()}")
-
-                yn = input("Do the emojis match? (Y/N) (C for Cancel) ")
-                if yn.lower() == "y":
-                    print(
-                        "Match! The verification for this "
-                        "device will be accepted."
-                    )
-                    resp = await client.confirm_short_auth_string(
-                        event.transaction_id
-                    )
-                    if isinstance(resp, ToDeviceError):
-                        print(f"confirm_short_auth_string failed with {resp}")
-                elif yn.lower() == "n":  # no, don't match, reject
-                    print(
-                        "No match! Device will NOT be verified "
-                        "by rejecting verification."
-                    )
-                    resp = await client.cancel_key_verification(
-                        event.transaction_id, reject=True
-                    )
-                    if isinstance(resp, ToDeviceError):
-                        print(f"cancel_key_verification failed with {resp}")
-                else:  # C or anything for cancel
-                    print("Cancelled by user! Verification will be cancelled.")
-                    resp = await client.cancel_key_verification(
-                        event.transaction_id, reject=False
-                    )
-                    if isinstance(resp, ToDeviceError):
-                        print(f"cancel_key_verification failed with {resp}")
-
-            elif isinstance(event, KeyVerificationMac):  # third step
-                """ Third step is to receive KeyVerificationMac"""
-                sas = client.key_verifications[event.transaction_id]
-                try:
-                    to_device_msg = sas.get_mac()
-                except LocalProtocolError as e:
-                    # e.g. it might have been cancelled by ourselves
-                    print(
-                        f"Cancelled or protocol error: Reason: {e}.\n"
-                        f"Verification with {event.sender} not concluded. "
-                        "Try again?"
-                    )
-                else:
-                    resp = await client.to_device(to_device_msg)
-                    if isinstance(resp, ToDeviceError):
-                        print(f"to_device failed with {resp}")
-                    print(
-                        f"sas.we_started_it = {sas.we_started_it}\n"
-                        f"sas.sas_accepted = {sas.sas_accepted}\n"
-                        f"sas.canceled = {sas.canceled}\n"
-                        f"sas.timed_out = {sas.timed_out}\n"
-                        f"sas.verified = {sas.verified}\n"
-                        f"sas.verified_devices = {sas.verified_devices}\n"
-                    )
-                    print(
-                        "Emoji verification was successful!\n"
-                        "Hit Control-C to stop the program or "
-                        "initiate another Emoji verification from "
-                        "another device or room."
-                    )
+            handler = self._to_device_handlers.get(type(event))
+            if handler is not None:
+                await handler(event)
             else:
-                print(
-                    f"Received unexpected event type {type(event)}. "
-                    f"Event is {event}. Event will be ignored."
+                logger.warning(
+                    "Received unexpected event type %s. "
+                    "Event is %s. Event will be ignored.",
+                    type(event), event,
                 )
-        except BaseException:
-            print(traceback.format_exc())
+        except Exception:
+            logger.exception("to_device_callback failed")
+
+    async def _on_key_verification_start(self, event):
+        """First step of the verification, the other device starts it"""
+        client = self.client
+        if "emoji" not in event.short_authentication_string:
+            logger.warning(
+                "Other device does not support emoji verification %s.",
+                event.short_authentication_string,
+            )
+            return
+        resp = await client.accept_key_verification(
+            event.transaction_id
+        )
+        if isinstance(resp, ToDeviceError):
+            logger.error("accept_key_verification failed with %s", resp)
+
+        sas = client.key_verifications[event.transaction_id]
+
+        to_device_msg = sas.share_key()
+        resp = await client.to_device(to_device_msg)
+        if isinstance(resp, ToDeviceError):
+            logger.error("to_device failed with %s", resp)
+
+    async def _on_key_verification_cancel(self, event):
+        """The other device cancelled the verification, may happen at any time"""
+        # There is no need to issue a
+        # client.cancel_key_verification(tx_id, reject=False)
+        # here. The SAS flow is already cancelled.
+        # We only need to inform the user.
+        logger.info(
+            'Verification has been cancelled by %s for reason "%s".',
+            event.sender, event.reason,
+        )
+
+    async def _on_key_verification_key(self, event):
+        """Second step of the verification, compare the emojis"""
+        client = self.client
+        sas = client.key_verifications[event.transaction_id]
+
+        # Printed rather than logged, the operator compares these at the prompt
+        print(f"{sas.get_emoji()}")
+
+        # Wait for the operator without blocking the event loop
+        yn = await _ainput("Do the emojis match? (Y/N) (C for Cancel) ")
+        if yn.lower() == "y":
+            logger.info(
+                "Match! The verification for this "
+                "device will be accepted."
+            )
+            resp = await client.confirm_short_auth_string(
+                event.transaction_id
+            )
+            if isinstance(resp, ToDeviceError):
+                logger.error("confirm_short_auth_string failed with %s", resp)
+        elif yn.lower() == "n":  # no, don't match, reject
+            logger.info(
+                "No match! Device will NOT be verified "
+                "by rejecting verification."
+            )
+            resp = await client.cancel_key_verification(
+                event.transaction_id, reject=True
+            )
+            if isinstance(resp, ToDeviceError):
+                logger.error("cancel_key_verification failed with %s", resp)
+        else:  # C or anything for cancel
+            logger.info("Cancelled by user! Verification will be cancelled.")
+            resp = await client.cancel_key_verification(
+                event.transaction_id, reject=False
+            )
+            if isinstance(resp, ToDeviceError):
+                logger.error("cancel_key_verification failed with %s", resp)
+
+    async def _on_key_verification_mac(self, event):
+        """Third and last step of the verification"""
+        client = self.client
+        sas = client.key_verifications[event.transaction_id]
+        try:
+            to_device_msg = sas.get_mac()
+        except LocalProtocolError as e:
+            # e.g. it might have been cancelled by ourselves
+            logger.error(
+                "Cancelled or protocol error: Reason: %s.\n"
+                "Verification with %s not concluded. "
+                "Try again?",
+                e, event.sender,
+            )
+        else:
+            resp = await client.to_device(to_device_msg)
+            if isinstance(resp, ToDeviceError):
+                logger.error("to_device failed with %s", resp)
+            logger.info(
+                "sas.we_started_it = %s\n"
+                "sas.sas_accepted = %s\n"
+                "sas.canceled = %s\n"
+                "sas.timed_out = %s\n"
+                "sas.verified = %s\n"
+                "sas.verified_devices = %s\n",
+                sas.we_started_it, sas.sas_accepted, sas.canceled,
+                sas.timed_out, sas.verified, sas.verified_devices,
+            )
+            logger.info(
+                "Emoji verification was successful!\n"
+                "Hit Control-C to stop the program or "
+                "initiate another Emoji verification from "
+                "another device or room."
+            )
 
     async def message(self, room, event):
         """Callback for when a message event is received
@@ -181,38 +255,50 @@ class Callbacks(object):
         msg = event.body
 
         # Ignore messages from ourselves
-        if event.sender == self.client.user:
+        if self._bot_user is None:
+            self._bot_user = self.client.user
+        if event.sender == self._bot_user:
             return
 
         logger.info(
-            f"Bot message received for room {room.display_name} | "
-            f"{room.user_name(event.sender)}: {msg}"
+            "Bot message received for room %s | %s: %s",
+            room.display_name, room.user_name(event.sender), msg,
         )
 
-        # process each line as separate message to check for commands
-        messages = msg.split("\n\n")
+        # Replies to all commands in this event, sent as a single message
+        reply_buffer = []
+
+        prefix = self.command_prefix
+        prefix_length = self._plen
+
+        # process each line as separate message to check for commands,
+        # most messages are a single line so skip the split for those
+        if "\n\n" in msg:
+            messages = msg.split("\n\n")
+        else:
+            messages = (msg,)
         for split_message in messages:
             # Process as message if in a public room without command prefix
-            has_command_prefix = split_message.startswith(self.command_prefix)
+            has_command_prefix = split_message.startswith(prefix)
             if not has_command_prefix and not room.is_group:
                 # General message listener
-                message = Message(self.client, self.store,
-                                  self.config, split_message, room, event)
-                await message.process()
+                await process_message(self.client, self.store, self.config,
+                                      split_message, room, event)
                 continue
 
             # Otherwise if this is in a 1-1 with the bot or features a command prefix,
             # treat it as a command
             if has_command_prefix:
-                # Remove the command prefix
-                split_message = split_message[len(self.command_prefix):]
-                # remove leading spaces
-                split_message = split_message.lstrip()
+                # Use the message without the command prefix and leading spaces
+                split_message = split_message[prefix_length:].lstrip()
 
             if split_message != "":
-                command = Command(self.client, self.store,
-                                  self.config, split_message, room, event)
-                await command.process()
+                await process_command(self._ctx, split_message, room, event,
+                                      reply_buffer)
+
+        if reply_buffer:
+            await send_text_to_room(
+                self.client, room.room_id, "\n\n".join(reply_buffer))
 
     async def event_unknown(self, room: MatrixRoom, event: UnknownEvent):
         """
@@ -224,17 +310,14 @@ class Callbacks(object):
 
     async def invite(self, room, event):
         """Callback for when an invite is received. Join the room specified in the invite"""
-        logger.debug(f"Got invite to {room.room_id} from {event.sender}.")
+        logger.debug("Got invite to %s from %s.", room.room_id, event.sender)
 
         if event.sender in self.config.botmasters:
             # Attempt to join 3 times before giving up
-            for attempt in range(3):
-                result = await self.client.join(room.room_id)
-                if type(result) == JoinError:
-                    logger.error(
-                        f"Error joining room {room.room_id} (attempt %d): %s",
-                        attempt, result.message,
-                    )
-                else:
-                    logger.info(f"Joined {room.room_id}")
-                    break
+            result = await _retry(
+                lambda: self.client.join(room.room_id), JoinError,
+                f"joining room {room.room_id}")
+            if isinstance(result, JoinError):
+                logger.error("Error joining room %s", room.room_id)
+            else:
+                logger.info("Joined %s", room.room_id)
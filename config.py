@@ -1,4 +1,8 @@
+import atexit
+import functools
 import logging
+import logging.handlers
+import queue
 import re
 import os
 import yaml
@@ -29,6 +33,8 @@ class Config(object):
         log_level = self._get_cfg(["logging", "level"], default="INFO")
         logger.setLevel(log_level)
 
+        handlers = []
+
         file_logging_enabled = self._get_cfg(
             ["logging", "file_logging", "enabled"], default=False)
         file_logging_filepath = self._get_cfg(
@@ -36,14 +42,24 @@ class Config(object):
         if file_logging_enabled:
             handler = logging.FileHandler(file_logging_filepath)
             handler.setFormatter(formatter)
-            logger.addHandler(handler)
+            handlers.append(handler)
 
         console_logging_enabled = self._get_cfg(
             ["logging", "console_logging", "enabled"], default=True)
         if console_logging_enabled:
             handler = logging.StreamHandler(sys.stdout)
             handler.setFormatter(formatter)
-            logger.addHandler(handler)
+            handlers.append(handler)
+
+        # Write the logs from a separate thread so that slow log output
+        # never blocks the event loop
+        if handlers:
+            log_queue = queue.SimpleQueue()
+            logger.addHandler(logging.handlers.QueueHandler(log_queue))
+            listener = logging.handlers.QueueListener(
+                log_queue, *handlers, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
 
         # Storage setup
         self.database_filepath = self._get_cfg(
@@ -79,6 +95,10 @@ class Config(object):
         self.ssl = self._get_cfg(["matrix", "ssl"], required=False)
         self.command_prefix = self._get_cfg(["command_prefix"], default="!c ")
 
+        # Sensor setup
+        self.sensor_poll_rate_ms = self._get_cfg(
+            ["sensor", "poll_rate_ms"], default=5000, required=False)
+
     def _get_cfg(
             self,
             path: List[str],
@@ -109,3 +129,16 @@ class Config(object):
 
         # We found the option. Return it
         return config
+
+
+@functools.lru_cache(maxsize=1)
+def load_config(filepath):
+    """Load the config file, only parsing it the first time
+
+    Config also sets up the log handlers, so creating it twice would log
+    everything twice.
+
+    Args:
+        filepath (str): Path to config file
+    """
+    return Config(filepath)
@@ -3,6 +3,25 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+async def process_message(client, store, config, message_content, room, event):
+    """Process and possibly respond to a message
+
+    Args:
+        client (nio.AsyncClient): nio client used to interact with matrix
+
+        store (Storage): Bot storage
+
+        config (Config): Bot configuration parameters
+
+        message_content (str): The body of the message
+
+        room (nio.rooms.MatrixRoom): The room the event came from
+
+        event (nio.events.room_events.RoomMessageText): The event defining the message
+    """
+    pass
+
+
 class Message(object):
 
     def __init__(self, client, store, config, message_content, room, event):
@@ -30,4 +49,5 @@ class Message(object):
 
     async def process(self):
         """Process and possibly respond to the message"""
-        pass
+        await process_message(self.client, self.store, self.config,
+                              self.message_content, self.room, self.event)
@@ -0,0 +1,176 @@
+import asyncio
+import gc
+import logging
+import random
+from asyncio import sleep
+
+from nio import (
+    AsyncClientConfig,
+    LocalProtocolError, LoginError)
+from aiohttp.client_exceptions import (
+    ServerDisconnectedError,
+    ClientConnectionError)
+from bot_client import BotClient
+from callbacks import Callbacks
+from storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+# Upper bound in seconds for the wait between two connection attempts
+MAX_BACKOFF = 30
+
+# Errors after which we reconnect to the homeserver
+RECONNECT_ERRORS = (
+    ClientConnectionError,
+    ServerDisconnectedError,
+    asyncio.TimeoutError,
+)
+
+
+def _backoff_delay(failures):
+    """Get how long to wait after a number of consecutive failures
+
+    The delay doubles with every failure, with some jitter so that restarted
+    bots do not all reconnect at once.
+    """
+    # Stop doubling once the cap is reached, the exponent would overflow the
+    # float conversion during a long outage
+    exponent = min(failures, MAX_BACKOFF.bit_length())
+    return min(MAX_BACKOFF, 2 ** exponent) + random.random()
+
+
+async def _login(client, config):
+    """Try to login with the configured username/password
+
+    Args:
+        client (nio.AsyncClient): The client to log in with
+
+        config (Config): Bot configuration parameters
+
+    Returns:
+        The login response, or None if logging in can't work with this setup
+    """
+    try:
+        return await client.login(
+            password=config.user_password,
+            device_name=config.device_name,
+        )
+    except LocalProtocolError as e:
+        # There's an edge case here where the user enables encryption but hasn't installed
+        # the correct C dependencies. In that case, a LocalProtocolError is raised on login.
+        # Warn the user if these conditions are met.
+        if config.enable_encryption:
+            logger.fatal(
+                "Failed to login and encryption is enabled. Have you installed the correct dependencies? "
+                "https://github.com/poljar/matrix-nio#installation"
+            )
+            return None
+        # We don't know why this was raised. Throw it at the user
+        logger.fatal("Error logging in: %s", e)
+        raise
+
+
+async def run_client(config, register_callbacks):
+    """Log in to matrix and keep syncing, reconnecting on failure
+
+    Args:
+        config (Config): Bot configuration parameters
+
+        register_callbacks (callable): Called with the client and the Callbacks
+            to register the event callbacks of the program
+    """
+    # Configure the database
+    store = get_storage(config.database_filepath)
+
+    # Configuration options for the AsyncClient
+    client_config = AsyncClientConfig(
+        max_limit_exceeded=0,
+        max_timeouts=0,
+        store_sync_tokens=True,
+        encryption_enabled=config.enable_encryption,
+    )
+
+    # Initialize the matrix client
+    client = BotClient(
+        config.homeserver_url,
+        config.user_id,
+        device_id=config.device_id,
+        store_path=config.store_filepath,
+        config=client_config,
+        ssl=config.ssl
+    )
+
+    # Set up event callbacks
+    callbacks = Callbacks(client, store, config)
+    register_callbacks(client, callbacks)
+
+    # Everything set up so far lives as long as the bot does, move it out of
+    # the garbage collector's way. Modules imported later on are not covered,
+    # so import them before this point.
+    gc.collect()
+    gc.freeze()
+
+    # Keep trying to reconnect on failure (with some time in-between)
+    error_retries: int = 0
+    connection_failures: int = 0
+    # loop.time() of the last successful login
+    last_success = None
+    loop = asyncio.get_running_loop()
+    # The client (and its connection pool) is reused across reconnects and
+    # only closed on shutdown
+    try:
+        while True:
+            try:
+                login_response = await _login(client, config)
+                if login_response is None:
+                    return False
+
+                # Check if login failed
+                if isinstance(login_response, LoginError):
+                    delay = _backoff_delay(error_retries)
+                    logger.error(
+                        "Failed to login: %s, retrying in %.1fs... (%d)",
+                        login_response.message, delay, error_retries)
+                    # try logging in a few times to work around temporary login errors during homeserver restarts
+                    if error_retries < 3:
+                        error_retries += 1
+                        await sleep(delay)
+                        continue
+                    else:
+                        return False
+                error_retries = 0
+
+                # Login succeeded!
+
+                # sync_forever uploads the encryption keys (required for
+                # participating in encrypted rooms) right after the first sync,
+                # which returns immediately. Uploading them here as well would
+                # race with it and send the same keys twice. The upload already
+                # follows a sync that doesn't wait, so running it in a task
+                # group next to the sync would not shorten startup.
+
+                logger.info("Logged in as %s", config.user_id)
+                last_success = loop.time()
+                # The room state is kept in memory, so after the first sync
+                # of this process only the changes are needed. The timeout only
+                # applies from the second sync on, nio doesn't long poll the first.
+                await client.sync_forever(
+                    timeout=30000, full_state=client.next_batch is None)
+            except RECONNECT_ERRORS as err:
+                logger.debug(err)
+
+                # A connection that stayed up for a while starts over with a short delay
+                if last_success is not None and loop.time() - last_success > MAX_BACKOFF:
+                    connection_failures = 0
+                last_success = None
+
+                delay = _backoff_delay(connection_failures)
+                connection_failures += 1
+                logger.warning(
+                    "Unable to connect to homeserver, retrying in %.1fs...", delay)
+
+                # Sleep so we don't bombard the server with login requests
+                await sleep(delay)
+    finally:
+        # Make sure to close the client connection on shutdown
+        await client.close()
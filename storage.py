@@ -1,4 +1,5 @@
 
+import functools
 import sqlite3
 import os.path
 import logging
@@ -45,3 +46,13 @@ class Storage(object):
         # Initialize a connection to the database
         self.conn = sqlite3.connect(self.db_path)
         self.cursor = self.conn.cursor()
+
+
+@functools.lru_cache(maxsize=1)
+def get_storage(db_path):
+    """Get the bot storage, opening the database only once per process
+
+    Args:
+        db_path (str): The name of the database file
+    """
+    return Storage(db_path)